@@ -1,14 +1,15 @@
 # must be built with scons
 from .messaging_pyx import Context, Poller, SubSocket, PubSocket, SocketEventHandle, toggle_fake_events, \
-                                set_fake_prefix, get_fake_prefix, delete_fake_prefix, wait_for_one_event
+                                set_fake_prefix, get_fake_prefix, delete_fake_prefix, wait_for_one_event, SubMasterState
 from .messaging_pyx import MultiplePublishersError, MessagingError
 
 import os
 import capnp
+import functools
 import time
+import numpy as np
 
-from typing import Optional, List, Union, Dict, Deque
-from collections import deque
+from typing import Optional, List, Union, Tuple
 
 from cereal import log
 from cereal.services import SERVICE_LIST
@@ -23,6 +24,7 @@ assert wait_for_one_event
 
 NO_TRAVERSAL_LIMIT = 2**64-1
 AVG_FREQ_HISTORY = 100
+DRAIN_BATCH_SIZE = 256
 
 context = Context()
 
@@ -36,14 +38,28 @@ def fake_event_handle(endpoint: str, identifier: Optional[str] = None, override:
   return handle
 
 
+# pycapnp's from_bytes is a generator based context manager, read_multiple_bytes gives the same reader
+# (pinning dat) without entering and exiting a context per message
+_read_events = log.Event.read_multiple_bytes
+
+
 def log_from_bytes(dat: bytes) -> capnp.lib.capnp._DynamicStructReader:
-  with log.Event.from_bytes(dat, traversal_limit_in_words=NO_TRAVERSAL_LIMIT) as msg:
+  for msg in _read_events(dat, traversal_limit_in_words=NO_TRAVERSAL_LIMIT):
     return msg
+  raise ValueError("no message in buffer")
+
+
+_new_event = log.Event.new_message
+
+# resolved schema fields, reading through these skips capnp's name based __getattr__ lookup
+_EVENT_FIELDS = log.Event.schema.fields
+_LOG_MONO_TIME_FIELD = _EVENT_FIELDS['logMonoTime']
+_VALID_FIELD = _EVENT_FIELDS['valid']
 
 
 def new_message(service: Optional[str] = None, size: Optional[int] = None) -> capnp.lib.capnp._DynamicStructBuilder:
-  dat = log.Event.new_message()
-  dat.logMonoTime = int(time.monotonic() * 1e9)
+  dat = _new_event()
+  dat.logMonoTime = time.monotonic_ns()
   dat.valid = True
   if service is not None:
     if size is None:
@@ -74,54 +90,26 @@ def sub_sock(endpoint: str, poller: Optional[Poller] = None, addr: str = "127.0.
 
 def drain_sock_raw(sock: SubSocket, wait_for_one: bool = False) -> List[bytes]:
   """Receive all message currently available on the queue"""
-  ret: List[bytes] = []
-  while 1:
-    if wait_for_one and len(ret) == 0:
-      dat = sock.receive()
-    else:
-      dat = sock.receive(non_blocking=True)
+  ret: List[bytes] = sock.receive_batch(DRAIN_BATCH_SIZE, non_blocking=not wait_for_one)
 
-    if dat is None:
-      break
-
-    ret.append(dat)
+  batch = ret
+  while len(batch) == DRAIN_BATCH_SIZE:
+    batch = sock.receive_batch(DRAIN_BATCH_SIZE, non_blocking=True)
+    ret.extend(batch)
 
   return ret
 
 
 def drain_sock(sock: SubSocket, wait_for_one: bool = False) -> List[capnp.lib.capnp._DynamicStructReader]:
   """Receive all message currently available on the queue"""
-  ret: List[capnp.lib.capnp._DynamicStructReader] = []
-  while 1:
-    if wait_for_one and len(ret) == 0:
-      dat = sock.receive()
-    else:
-      dat = sock.receive(non_blocking=True)
-
-    if dat is None:  # Timeout hit
-      break
-
-    dat = log_from_bytes(dat)
-    ret.append(dat)
-
-  return ret
+  # parsed per message, so a reader that's kept around only pins its own payload
+  return [log_from_bytes(dat) for dat in drain_sock_raw(sock, wait_for_one=wait_for_one)]
 
 
 # TODO: print when we drop packets?
 def recv_sock(sock: SubSocket, wait: bool = False) -> Optional[capnp.lib.capnp._DynamicStructReader]:
   """Same as drain sock, but only returns latest message. Consider using conflate instead."""
-  dat = None
-
-  while 1:
-    if wait and dat is None:
-      rcv = sock.receive()
-    else:
-      rcv = sock.receive(non_blocking=True)
-
-    if rcv is None:  # Timeout hit
-      break
-
-    dat = rcv
+  dat = sock.receive_latest(non_blocking=not wait)
 
   if dat is not None:
     dat = log_from_bytes(dat)
@@ -151,6 +139,18 @@ def recv_one_retry(sock: SubSocket) -> capnp.lib.capnp._DynamicStructReader:
       return log_from_bytes(dat)
 
 
+@functools.lru_cache(maxsize=None)
+def _default_data(service: str) -> Tuple[capnp.lib.capnp._DynamicStructReader, bool]:
+  # readers are immutable, so every SubMaster can share the same empty message per service
+  try:
+    data = new_message(service)
+  except capnp.lib.capnp.KjException:  # pylint: disable=c-extension-no-member
+    data = new_message(service, 0) # lists
+
+  reader = data.as_reader()
+  return getattr(reader, service), reader.valid
+
+
 class SubMaster:
   def __init__(self, services: List[str], poll: Optional[List[str]] = None,
                ignore_alive: Optional[List[str]] = None, ignore_avg_freq: Optional[List[str]] = None,
@@ -161,7 +161,6 @@ class SubMaster:
     self.rcv_frame = {s: 0 for s in services}
     self.alive = {s: False for s in services}
     self.freq_ok = {s: False for s in services}
-    self.recv_dts: Dict[str, Deque[float]] = {s: deque(maxlen=AVG_FREQ_HISTORY) for s in services}
     self.sock = {}
     self.freq = {}
     self.data = {}
@@ -169,123 +168,122 @@ class SubMaster:
     self.logMonoTime = {}
 
     self.poller = Poller()
-    self.non_polled_services = [s for s in services if poll is not None and
-                                len(poll) and s not in poll]
+    poll_set = frozenset(poll) if poll else None
+    self.non_polled_services = [s for s in services if poll_set is not None and s not in poll_set]
 
     self.ignore_average_freq = [] if ignore_avg_freq is None else ignore_avg_freq
     self.ignore_alive = [] if ignore_alive is None else ignore_alive
     self.simulation = bool(int(os.getenv("SIMULATION", "0")))
 
+    # per-service constants used every update, precomputed once
+    self._non_polled_set = frozenset(self.non_polled_services)
+    self._ignore_avg_freq_set = frozenset(self.ignore_average_freq)
+    self._ignore_alive_set = frozenset(self.ignore_alive)
+
     for s in services:
       if addr is not None:
-        p = self.poller if s not in self.non_polled_services else None
+        p = self.poller if s not in self._non_polled_set else None
         self.sock[s] = sub_sock(s, poller=p, addr=addr, conflate=True)
       self.freq[s] = SERVICE_LIST[s].frequency
 
-      try:
-        data = new_message(s)
-      except capnp.lib.capnp.KjException:  # pylint: disable=c-extension-no-member
-        data = new_message(s, 0) # lists
-
-      self.data[s] = getattr(data, s)
+      self.data[s], self.valid[s] = _default_data(s)
       self.logMonoTime[s] = 0
-      self.valid[s] = data.valid
+
+    self._non_polled_socks = tuple(self.sock[s] for s in self.non_polled_services if s in self.sock)
+    self._check_avg_freq_set = frozenset(s for s in services if self.freq[s] > 1e-5 and
+                                         s not in self._non_polled_set and s not in self._ignore_avg_freq_set)
+
+    # per-service state, indexed by position in self._services
+    self._services = tuple(self.data)
+    self._idx = {s: i for i, s in enumerate(self._services)}
+    self._fields = tuple(_EVENT_FIELDS[s] for s in self._services)
+    freqs = [self.freq[s] for s in self._services]
+    # arbitrary small number to avoid float comparison. If freq is 0, we can skip the checks
+    # alive if delay is within 10x the expected frequency
+    alive_thresh = [10. / f if f > 1e-5 else np.inf for f in freqs]
+    # freq_ok if average frequency is higher than 90% of expected frequency
+    expected_dt = [1. / (f * 0.90) if f > 1e-5 else np.inf for f in freqs]
+    check_avg = [s in self._check_avg_freq_set for s in self._services]
+
+    # alive/freq_ok and the dt history are kept up to date in C. the public dicts are the only copy of
+    # rcv_time/alive/freq_ok/valid, SubMasterState reads and writes them in place, the all_* checks run there too.
+    # in simulation alive/freq_ok are forced on receive, so no dt history is allocated
+    history = 0 if self.simulation else AVG_FREQ_HISTORY
+    self._state = SubMasterState(self._services, alive_thresh, expected_dt, check_avg, history, self._ignore_alive_set,
+                                 self.rcv_time, self.alive, self.freq_ok, self.valid)
 
   def __getitem__(self, s: str) -> capnp.lib.capnp._DynamicStructReader:
     return self.data[s]
 
-  def _check_avg_freq(self, s):
-    return self.rcv_time[s] > 1e-5 and self.freq[s] > 1e-5 and (s not in self.non_polled_services) \
-            and (s not in self.ignore_average_freq)
-
   def update(self, timeout: int = 1000) -> None:
-    msgs = []
-    for sock in self.poller.poll(timeout):
-      msgs.append(recv_one_or_none(sock))
+    # poll, then non-blocking receive on the ready and the non-polled sockets, all in one call without the GIL
+    dats = self.poller.poll_recv_all(timeout, self._non_polled_socks)
 
-    # non-blocking receive for non-polled sockets
-    for s in self.non_polled_services:
-      msgs.append(recv_one_or_none(self.sock[s]))
-    self.update_msgs(time.monotonic(), msgs)
+    # parsed per message, the readers are kept in self.data and should only pin their own payload
+    self.update_msgs(time.monotonic(), [log_from_bytes(dat) for dat in dats])
 
   def update_msgs(self, cur_time: float, msgs: List[capnp.lib.capnp._DynamicStructReader]) -> None:
+    # cur_time and rcv_time are float seconds on the time.monotonic() clock, callers outside update() rely on this
     self.frame += 1
-    self.updated = dict.fromkeys(self.updated, False)
+    # reset in place, every key so flags set from outside are cleared too
+    updated = self.updated
+    for s in self._services:
+      updated[s] = False
+
+    received = []
     for msg in msgs:
       if msg is None:
         continue
 
       s = msg.which()
-      self.updated[s] = True
+      i = self._idx[s]
+      updated[s] = True
+      received.append(i)
 
-      if self._check_avg_freq(s):
-        self.recv_dts[s].append(cur_time - self.rcv_time[s])
-
-      self.rcv_time[s] = cur_time
       self.rcv_frame[s] = self.frame
-      self.data[s] = getattr(msg, s)
-      self.logMonoTime[s] = msg.logMonoTime
-      self.valid[s] = msg.valid
-
-      if self.simulation:
-        self.freq_ok[s] = True
-        self.alive[s] = True
-
-    if not self.simulation:
-      for s in self.data:
-        # arbitrary small number to avoid float comparison. If freq is 0, we can skip the check
-        if self.freq[s] > 1e-5:
-          # alive if delay is within 10x the expected frequency
-          self.alive[s] = (cur_time - self.rcv_time[s]) < (10. / self.freq[s])
-
-          # TODO: check if update frequency is high enough to not drop messages
-          # freq_ok if average frequency is higher than 90% of expected frequency
-          if self._check_avg_freq(s):
-            if len(self.recv_dts[s]) > 0:
-              avg_dt = sum(self.recv_dts[s]) / len(self.recv_dts[s])
-              expected_dt = 1 / (self.freq[s] * 0.90)
-              self.freq_ok[s] = (avg_dt < expected_dt)
-            else:
-              self.freq_ok[s] = False
-          else:
-            self.freq_ok[s] = True
-        else:
-          self.freq_ok[s] = True
-          self.alive[s] = True
+      self.data[s] = msg._get_by_field(self._fields[i])
+      self.logMonoTime[s] = msg._get_by_field(_LOG_MONO_TIME_FIELD)
+      self.valid[s] = msg._get_by_field(_VALID_FIELD)
+
+    self._state.update(cur_time, received, self.simulation)
 
   def all_alive(self, service_list=None) -> bool:
-    if service_list is None:  # check all
-      service_list = self.alive.keys()
-    return all(self.alive[s] for s in service_list if s not in self.ignore_alive)
+    return self._state.all_alive(service_list)
 
   def all_freq_ok(self, service_list=None) -> bool:
-    if service_list is None:  # check all
-      service_list = self.alive.keys()
-    return all(self.freq_ok[s] for s in service_list if s not in self.ignore_alive)
+    return self._state.all_freq_ok(service_list)
 
   def all_valid(self, service_list=None) -> bool:
-    if service_list is None:  # check all
-      service_list = self.valid.keys()
-    return all(self.valid[s] for s in service_list)
+    return self._state.all_valid(service_list)
 
   def all_checks(self, service_list=None) -> bool:
-    if service_list is None:  # check all
-      service_list = self.alive.keys()
-    return self.all_alive(service_list=service_list) \
-           and self.all_freq_ok(service_list=service_list) \
-           and self.all_valid(service_list=service_list)
+    return self._state.all_checks(service_list)
 
 
 class PubMaster:
   def __init__(self, services: List[str]):
     self.sock = {}
+    self._send = {}
+    self._send_segments = {}
     for s in services:
       self.sock[s] = pub_sock(s)
+      self._send[s] = self.sock[s].send
+      self._send_segments[s] = self.sock[s].send_segments
 
   def send(self, s: str, dat: Union[bytes, capnp.lib.capnp._DynamicStructBuilder]) -> None:
-    if not isinstance(dat, bytes):
-      dat = dat.to_bytes()
-    self.sock[s].send(dat)
+    # PubSocket.send only takes exact bytes anyway, so the cheaper exact type check is enough
+    if type(dat) is bytes:
+      self._send[s](dat)
+    else:
+      # to_bytes() builds a new flat array and bytes object per call, send_segments frames into a reused buffer.
+      # measured about 2x faster for a 300 KB message and 10x for 6 MB, the number of copies is the same
+      self._send_segments[s](dat.to_segments())  # type: ignore[union-attr]
+
+  def send_bytes(self, s: str, dat: bytes) -> None:
+    self._send[s](dat)
+
+  def send_builder(self, s: str, dat: capnp.lib.capnp._DynamicStructBuilder) -> None:
+    self._send_segments[s](dat.to_segments())
 
   def wait_for_readers_to_update(self, s: str, timeout: int, dt: float = 0.05) -> bool:
     for _ in range(int(timeout*(1./dt))):
@@ -2,11 +2,14 @@
 # cython: c_string_encoding=ascii, language_level=3
 
 import sys
+import numpy as np
+cimport cython
 from libcpp.string cimport string
 from libcpp.vector cimport vector
 from libcpp cimport bool
 from libc cimport errno
-from libc.string cimport strerror
+from libc.string cimport strerror, memcpy, memset
+from libc.stdint cimport uint32_t
 from cython.operator import dereference
 
 
@@ -160,6 +163,42 @@ cdef class Poller:
 
     return sockets
 
+  def poll_recv_all(self, int timeout, non_polled_sockets=()):
+    """Poll, then do one non-blocking receive on every ready socket and on each of non_polled_sockets.
+    Returns the received messages, ready sockets first"""
+    cdef vector[cppSubSocket*] sockets
+    cdef vector[cppMessage*] msgs
+    cdef cppMessage * msg
+    cdef SubSocket socket
+    cdef int t = timeout
+    cdef bool interrupted = False
+
+    for socket in non_polled_sockets:
+      sockets.push_back(socket.socket)
+
+    with nogil:
+      result = self.poller.poll(t)
+      sockets.insert(sockets.begin(), result.begin(), result.end())
+      for i in range(sockets.size()):
+        msg = sockets[i].receive(True)
+        if msg != NULL:
+          msgs.push_back(msg)
+        elif errno.errno == errno.EINTR:
+          interrupted = True
+
+    # a receive interrupted by SIGINT exits like SubSocket.receive does, once the GIL is held again
+    if interrupted:
+      print("SIGINT received, exiting")
+      for msg in msgs:
+        del msg
+      sys.exit(1)
+
+    ret = []
+    for msg in msgs:
+      ret.append(msg.getData()[:msg.getSize()])
+      del msg
+    return ret
+
 
 cdef class SubSocket:
   cdef cppSubSocket * socket
@@ -212,9 +251,68 @@ cdef class SubSocket:
 
       return m
 
+  cdef _receive_many(self, vector[cppMessage*] &msgs, int max_n, bool non_blocking):
+    # only the first receive may block, the rest of the queue is drained non-blocking
+    cdef cppMessage * msg
+    cdef bool nb = non_blocking
+
+    while <int>msgs.size() < max_n:
+      msg = self.socket.receive(nb)
+
+      if msg == NULL:
+        if errno.errno == errno.EINTR:
+          print("SIGINT received, exiting")
+          for msg in msgs:
+            del msg
+          sys.exit(1)
+        break
+
+      msgs.push_back(msg)
+      nb = True
+
+  def receive_batch(self, int max_n, bool non_blocking=False):
+    """Receive up to max_n messages in one call. Only the first receive blocks, unless non_blocking is set"""
+    cdef vector[cppMessage*] msgs
+    self._receive_many(msgs, max_n, non_blocking)
+
+    ret = []
+    for msg in msgs:
+      ret.append(msg.getData()[:msg.getSize()])
+      del msg
+    return ret
+
+  def receive_latest(self, bool non_blocking=False):
+    """Drain the queue and return only the newest message, or None. Only the first receive blocks, unless non_blocking is set"""
+    cdef cppMessage * msg
+    cdef cppMessage * latest = NULL
+    cdef bool nb = non_blocking
+
+    while True:
+      msg = self.socket.receive(nb)
+
+      if msg == NULL:
+        if errno.errno == errno.EINTR:
+          print("SIGINT received, exiting")
+          del latest
+          sys.exit(1)
+        break
+
+      # older messages are dropped without ever being copied out
+      del latest
+      latest = msg
+      nb = True
+
+    if latest == NULL:
+      return None
+
+    m = latest.getData()[:latest.getSize()]
+    del latest
+    return m
+
 
 cdef class PubSocket:
   cdef cppPubSocket * socket
+  cdef vector[char] send_buf
 
   def __cinit__(self):
     self.socket = cppPubSocket.create()
@@ -243,5 +341,156 @@ cdef class PubSocket:
       else:
         raise MessagingError
 
+  def send_segments(self, list segments):
+    """Send a capnp message given as its segments (builder.to_segments()), framed the same as builder.to_bytes().
+    The framing buffer is kept between sends and never shrinks, so the socket holds on to its largest message's size"""
+    cdef size_t num_segments = len(segments)
+    cdef size_t header_size = (num_segments // 2 + 1) * 8
+    cdef size_t length = header_size
+    cdef uint32_t * header
+    cdef char * dst
+    cdef bytes seg
+
+    for seg in segments:
+      length += len(seg)
+
+    # the buffer is reused between sends and only grows
+    if self.send_buf.size() < length:
+      self.send_buf.resize(length)
+
+    # segment table: (segment count - 1), then each segment size in words, padded to a full word
+    header = <uint32_t*>self.send_buf.data()
+    memset(header, 0, header_size)
+    header[0] = num_segments - 1
+    dst = self.send_buf.data() + header_size
+    for i, seg in enumerate(segments):
+      header[i + 1] = len(seg) // 8
+      memcpy(dst, <char*>seg, len(seg))
+      dst += len(seg)
+
+    r = self.socket.send(self.send_buf.data(), length)
+
+    if r != length:
+      if errno.errno == errno.EADDRINUSE:
+        raise MultiplePublishersError
+      else:
+        raise MessagingError
+
   def all_readers_updated(self):
     return self.socket.all_readers_updated()
+
+
+cdef class SubMasterState:
+  """Per-service receive bookkeeping for SubMaster. Services are referred to by index into services.
+  The rcv_time/alive/freq_ok/valid dicts passed in are the only copy of those values, they're read and updated in place"""
+  cdef tuple _services
+  cdef frozenset _ignore_alive
+  cdef dict _rcv_time_dict, _alive_dict, _freq_ok_dict, _valid_dict
+  cdef double[::1] _alive_thresh, _expected_dt, _dt_sum
+  cdef double[:, ::1] _dt_ring
+  cdef int[::1] _dt_head, _dt_count
+  cdef unsigned char[::1] _check_avg
+  cdef int history
+
+  def __init__(self, tuple services, alive_thresh, expected_dt, check_avg, int history, ignore_alive,
+               dict rcv_time, dict alive, dict freq_ok, dict valid):
+    n = len(services)
+    self.history = history
+    self._services = services
+    self._ignore_alive = frozenset(ignore_alive)
+    self._rcv_time_dict = rcv_time
+    self._alive_dict = alive
+    self._freq_ok_dict = freq_ok
+    self._valid_dict = valid
+
+    self._alive_thresh = np.array(alive_thresh, dtype=np.float64)
+    self._expected_dt = np.array(expected_dt, dtype=np.float64)
+    self._check_avg = np.array(check_avg, dtype=np.bool_).view(np.uint8)
+
+    # ring buffer of the last history receive dts, with a running sum for the average.
+    # one contiguous (n, history) block, history can be 0 when freq_ok is never computed
+    self._dt_ring = np.zeros((n, history))
+    self._dt_head = np.zeros(n, dtype=np.intc)
+    self._dt_count = np.zeros(n, dtype=np.intc)
+    self._dt_sum = np.zeros(n)
+
+  @cython.wraparound(False)
+  def update(self, double cur_time, list received, bool simulation):
+    """Record a receive at cur_time for each service index in received, then refresh alive and freq_ok"""
+    cdef Py_ssize_t i, j
+    cdef int head
+    cdef double dt, total, rcv_time
+
+    for i in received:
+      s = self._services[i]
+      rcv_time = self._rcv_time_dict[s]
+
+      # the dt history is only used for freq_ok, which isn't computed in simulation
+      if not simulation and self.history > 0 and self._check_avg[i] and rcv_time > 1e-5:
+        dt = cur_time - rcv_time
+        head = self._dt_head[i]
+        self._dt_sum[i] += dt - self._dt_ring[i, head]
+        self._dt_ring[i, head] = dt
+        head = (head + 1) % self.history
+        if head == 0:
+          # resum once per wrap so float error in the running sum can't accumulate
+          total = 0.
+          for j in range(self.history):
+            total += self._dt_ring[i, j]
+          self._dt_sum[i] = total
+        self._dt_head[i] = head
+        if self._dt_count[i] < self.history:
+          self._dt_count[i] += 1
+
+      self._rcv_time_dict[s] = cur_time
+
+      if simulation:
+        self._alive_dict[s] = True
+        self._freq_ok_dict[s] = True
+
+    if simulation:
+      return
+
+    for i in range(len(self._services)):
+      s = self._services[i]
+      rcv_time = self._rcv_time_dict[s]
+      self._alive_dict[s] = (cur_time - rcv_time) < self._alive_thresh[i]
+
+      # TODO: check if update frequency is high enough to not drop messages
+      if self._check_avg[i] and rcv_time > 1e-5:
+        self._freq_ok_dict[s] = self._dt_count[i] > 0 and (self._dt_sum[i] / self._dt_count[i]) < self._expected_dt[i]
+      else:
+        self._freq_ok_dict[s] = True
+
+  # the checks read the dicts, so values written from outside (tests, replay) are honored.
+  # plain loops that stop at the first failing service, numpy reductions cost more than they save for ~10 services
+  cdef bint _all(self, dict values, service_list, bint skip_ignored) except -1:
+    if service_list is None:
+      service_list = self._services
+
+    for s in service_list:
+      if skip_ignored and s in self._ignore_alive:
+        continue
+      if not values[s]:
+        return False
+    return True
+
+  def all_alive(self, service_list=None):
+    return self._all(self._alive_dict, service_list, True)
+
+  def all_freq_ok(self, service_list=None):
+    return self._all(self._freq_ok_dict, service_list, True)
+
+  def all_valid(self, service_list=None):
+    return self._all(self._valid_dict, service_list, False)
+
+  def all_checks(self, service_list=None):
+    if service_list is None:
+      service_list = self._services
+
+    for s in service_list:
+      if s not in self._ignore_alive and not (self._alive_dict[s] and self._freq_ok_dict[s]):
+        return False
+      if not self._valid_dict[s]:
+        return False
+    return True
@@ -137,6 +137,41 @@ class TestPoller(unittest.TestCase):
     del sub
     context.term()
 
+  def test_poll_recv_all(self):
+    context = messaging.Context()
+
+    pub_polled = messaging.PubSocket()
+    pub_polled.connect(context, 'controlsState')
+    pub_non_polled = messaging.PubSocket()
+    pub_non_polled.connect(context, 'carState')
+
+    p = messaging.Poller()
+    sub_polled = messaging.SubSocket()
+    sub_polled.connect(context, 'controlsState', conflate=True)
+    p.registerSocket(sub_polled)
+    sub_non_polled = messaging.SubSocket()
+    sub_non_polled.connect(context, 'carState', conflate=True)
+
+    time.sleep(0.1)  # Slow joiner
+
+    # nothing sent, poll times out
+    self.assertEqual(p.poll_recv_all(10, (sub_non_polled,)), [])
+
+    pub_polled.send(b"a")
+    pub_non_polled.send(b"b")
+    time.sleep(0.1)
+
+    # polled sockets come first
+    self.assertEqual(p.poll_recv_all(1000, (sub_non_polled,)), [b"a", b"b"])
+
+    # the poller holds a reference to sub_polled, zmq can't terminate the context until it's gone
+    del p
+    del pub_polled
+    del pub_non_polled
+    del sub_polled
+    del sub_non_polled
+    context.term()
+
 
 if __name__ == "__main__":
   unittest.main()
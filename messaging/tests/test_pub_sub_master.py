@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
+import os
 import random
 import time
 from typing import Sized, cast
 import unittest
+from unittest import mock
 
 import cereal.messaging as messaging
 from cereal.messaging.tests.test_messaging import events, random_sock, random_socks, \
@@ -10,6 +12,12 @@ from cereal.messaging.tests.test_messaging import events, random_sock, random_so
                                                   zmq_sleep
 
 
+def msg_reader(s, valid=True):
+  msg = messaging.new_message(s)
+  msg.valid = valid
+  return msg.as_reader()
+
+
 class TestSubMaster(unittest.TestCase):
 
   def setUp(self):
@@ -75,13 +83,153 @@ class TestSubMaster(unittest.TestCase):
       self.assertFalse(any(sm.updated.values()))
 
   def test_alive(self):
-    pass
+    # carState and controlsState are 100Hz, alive within 10x the expected dt
+    sm = messaging.SubMaster(["carState", "controlsState"], addr=None)
+    t = 100.
+    sm.update_msgs(t, [msg_reader("carState"), msg_reader("controlsState")])
+    self.assertTrue(all(sm.alive.values()))
+    self.assertTrue(sm.all_alive())
+    self.assertEqual(sm.rcv_time["carState"], t)
+
+    sm.update_msgs(t + 0.05, [])
+    self.assertTrue(sm.all_alive())
+
+    sm.update_msgs(t + 0.2, [msg_reader("controlsState")])
+    self.assertFalse(sm.alive["carState"])
+    self.assertTrue(sm.alive["controlsState"])
+    self.assertFalse(sm.all_alive())
+    self.assertTrue(sm.all_alive(["controlsState"]))
+    self.assertEqual(sm.rcv_time["carState"], t)
+    self.assertEqual(sm.rcv_time["controlsState"], t + 0.2)
 
   def test_ignore_alive(self):
-    pass
+    sm = messaging.SubMaster(["carState", "controlsState"], ignore_alive=["carState"], addr=None)
+    sm.update_msgs(100., [msg_reader("carState"), msg_reader("controlsState")])
+    for i in range(1, 20):
+      sm.update_msgs(100. + i * 0.01, [msg_reader("controlsState")])
+    self.assertFalse(sm.alive["carState"])
+    self.assertFalse(sm.freq_ok["carState"])
+    self.assertTrue(sm.all_alive())
+    self.assertTrue(sm.all_freq_ok())
+    self.assertTrue(sm.all_checks())
 
   def test_valid(self):
-    pass
+    sm = messaging.SubMaster(["carState", "controlsState"], addr=None)
+    self.assertTrue(sm.all_valid())
+
+    sm.update_msgs(100., [msg_reader("carState", valid=False)])
+    self.assertFalse(sm.valid["carState"])
+    self.assertFalse(sm.all_valid())
+    self.assertTrue(sm.all_valid(["controlsState"]))
+
+    sm.update_msgs(100.01, [msg_reader("carState")])
+    self.assertTrue(sm.valid["carState"])
+    self.assertTrue(sm.all_valid())
+
+  def test_freq_ok(self):
+    sock = "carState"
+    sm = messaging.SubMaster([sock,], addr=None)
+    t = 100.
+
+    # no average yet after the first receive
+    sm.update_msgs(t, [msg_reader(sock)])
+    self.assertFalse(sm.freq_ok[sock])
+
+    # more than a full dt history at the expected rate
+    for _ in range(2 * messaging.AVG_FREQ_HISTORY + 10):
+      t += 0.01
+      sm.update_msgs(t, [msg_reader(sock)])
+      self.assertTrue(sm.freq_ok[sock])
+
+    # a full history at half the expected rate, still alive but too slow
+    for _ in range(messaging.AVG_FREQ_HISTORY):
+      t += 0.02
+      sm.update_msgs(t, [msg_reader(sock)])
+    self.assertTrue(sm.alive[sock])
+    self.assertFalse(sm.freq_ok[sock])
+    self.assertFalse(sm.all_freq_ok())
+    self.assertFalse(sm.all_checks())
+
+    # recovers once the slow dts are out of the history
+    for _ in range(messaging.AVG_FREQ_HISTORY):
+      t += 0.01
+      sm.update_msgs(t, [msg_reader(sock)])
+    self.assertTrue(sm.freq_ok[sock])
+    self.assertTrue(sm.all_checks())
+
+  def test_ignore_avg_freq(self):
+    sm = messaging.SubMaster(["carState", "controlsState"], ignore_avg_freq=["carState"], addr=None)
+    for i in range(messaging.AVG_FREQ_HISTORY):
+      sm.update_msgs(100. + i * 0.05, [msg_reader("carState"), msg_reader("controlsState")])
+    self.assertTrue(sm.freq_ok["carState"])
+    self.assertFalse(sm.freq_ok["controlsState"])
+    self.assertTrue(sm.all_alive())
+
+  def test_non_polled(self):
+    sm = messaging.SubMaster(["carState", "controlsState"], poll=["carState"], addr=None)
+    self.assertEqual(sm.non_polled_services, ["controlsState"])
+
+    # the average frequency isn't checked for non polled services
+    for i in range(messaging.AVG_FREQ_HISTORY):
+      sm.update_msgs(100. + i * 0.05, [msg_reader("carState"), msg_reader("controlsState")])
+    self.assertTrue(sm.freq_ok["controlsState"])
+    self.assertFalse(sm.freq_ok["carState"])
+
+  def test_simulation(self):
+    with mock.patch.dict(os.environ, {"SIMULATION": "1"}):
+      sm = messaging.SubMaster(["carState", "controlsState"], addr=None)
+    self.assertTrue(sm.simulation)
+
+    # alive and freq_ok are set on receive and never time out
+    sm.update_msgs(100., [msg_reader("carState")])
+    sm.update_msgs(200., [])
+    self.assertTrue(sm.alive["carState"])
+    self.assertTrue(sm.freq_ok["carState"])
+    self.assertFalse(sm.alive["controlsState"])
+    self.assertFalse(sm.freq_ok["controlsState"])
+    self.assertEqual(sm.rcv_time["carState"], 100.)
+    self.assertTrue(sm.all_checks(["carState"]))
+    self.assertFalse(sm.all_checks())
+
+  def test_all_checks(self):
+    services = ["carState", "controlsState", "radarState"]
+    sm = messaging.SubMaster(services, addr=None)
+    self.assertFalse(sm.all_checks())
+    self.assertTrue(sm.all_checks([]))
+
+    t = 100.
+    for _ in range(20):
+      t += 0.01
+      sm.update_msgs(t, [msg_reader("carState"), msg_reader("controlsState", valid=False)])
+    self.assertTrue(sm.all_checks(["carState"]))
+    self.assertFalse(sm.all_checks(["carState", "controlsState"]))
+    self.assertFalse(sm.all_checks(["carState", "radarState"]))
+    self.assertFalse(sm.all_checks())
+
+  def test_checks_read_dicts(self):
+    # values set from outside, e.g. by a test or replay harness, are honored by the checks
+    services = ["carState", "controlsState"]
+    sm = messaging.SubMaster(services, addr=None)
+    self.assertFalse(sm.all_checks())
+    for s in services:
+      sm.alive[s] = True
+      sm.freq_ok[s] = True
+    self.assertTrue(sm.all_alive())
+    self.assertTrue(sm.all_freq_ok())
+    self.assertTrue(sm.all_checks())
+
+    sm.valid["carState"] = False
+    self.assertFalse(sm.all_valid())
+    self.assertFalse(sm.all_checks())
+    self.assertTrue(sm.all_checks(["controlsState"]))
+
+  def test_updated_reset(self):
+    sm = messaging.SubMaster(["carState", "controlsState"], addr=None)
+    sm.updated["controlsState"] = True
+    sm.update_msgs(100., [msg_reader("carState")])
+    self.assertEqual(sm.updated, {"carState": True, "controlsState": False})
+    sm.update_msgs(100.01, [])
+    self.assertFalse(any(sm.updated.values()))
 
   # SubMaster should always conflate
   def test_conflate(self):
@@ -136,6 +284,34 @@ class TestPubMaster(unittest.TestCase):
           msg = msg.to_bytes()
         self.assertEqual(msg, recvd, i)
 
+  def test_send_bytes_builder(self):
+    sock = "carState"
+    pm = messaging.PubMaster([sock,])
+    sub_sock = messaging.sub_sock(sock, conflate=True, timeout=1000)
+    zmq_sleep()
+
+    msg = random_carstate()
+    pm.send_builder(sock, msg)
+    msg.clear_write_flag()
+    self.assertEqual(msg.to_bytes(), sub_sock.receive())
+
+    dat = random_bytes()
+    pm.send_bytes(sock, dat)
+    self.assertEqual(dat, sub_sock.receive())
+
+  def test_send_multi_segment(self):
+    sock = "can"
+    pm = messaging.PubMaster([sock,])
+    sub_sock = messaging.sub_sock(sock, conflate=True, timeout=1000)
+    zmq_sleep()
+
+    # large enough for the builder to allocate more than one segment
+    msg = messaging.new_message(sock, 10000)
+    self.assertGreater(len(msg.to_segments()), 1)
+    pm.send(sock, msg)
+    msg.clear_write_flag()
+    self.assertEqual(msg.to_bytes(), sub_sock.receive())
+
 
 if __name__ == "__main__":
   unittest.main()